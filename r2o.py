@@ -1,46 +1,61 @@
 from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
 import json
 import os
 import re
 import sys
-from typing import Match, cast
+from typing import Iterable, Iterator, TypeVar
 from typing_extensions import Final, NotRequired, TypedDict
 
-from dateutil.parser import parse
+import orjson
 from tqdm import tqdm
 
-re_daily: Final = re.compile(
-    r"(January|February|March|April|May|June|July|August|September|October|November|December) ([0-9]+)[a-z]{2}, ([0-9]{4})"
+WRITE_BUFFER_SIZE: Final = 1 << 20  # 1 MiB
+MONTHS: Final = {
+    "January": 1,
+    "February": 2,
+    "March": 3,
+    "April": 4,
+    "May": 5,
+    "June": 6,
+    "July": 7,
+    "August": 8,
+    "September": 9,
+    "October": 10,
+    "November": 11,
+    "December": 12,
+}
+date_pattern: Final = (
+    r"(?P<month>" + "|".join(MONTHS) + r") (?P<day>[0-9]+)[a-z]{2}, (?P<year>[0-9]{4})"
 )
-re_daylink: Final = re.compile(
-    r"(\[\[)([January|February|March|April|May|June|July|August|September|October|November|December [0-9]+[a-z]{2}, [0-9]{4})(\]\])"
+re_daily: Final = re.compile(date_pattern)
+re_daylink: Final = re.compile(r"\[\[" + date_pattern + r"\]\]")
+re_blockref: Final = re.compile(r"\(\((.{9})\)\)")
+
+TITLE_TRANS: Final = str.maketrans(
+    {
+        ":": " -",  # no colons allowed in file names
+        '"': None,
+        "^": None,
+        "\\": None,  # backslashes are also a bad idea
+    }
 )
-re_blockmentions: Final = re.compile(r"({{mentions: \(\()(.{9})(\)\)}})")
-re_blockembed: Final = re.compile(r"({{embed: \(\()(.{9})(\)\)}})")
-re_blockref: Final = re.compile(r"(\(\()(.{9})(\)\))")
 
+T = TypeVar("T")
 
-class BlockBase(TypedDict):
-    """Base for the ``Block`` and ``ExtendedBlock`` typed dictionaries."""
+_PREFIX_CACHE: dict[int, tuple[str, str]] = {}
+_DIRS_DONE: set[str] = set()
 
-    uid: str
-    string: str
-    heading: NotRequired[int]
 
-
-class Block(BlockBase):
+class Block(TypedDict):
     """Dictionary that represents how a block is stored in Roam's JSON format."""
 
+    uid: str
+    string: str
+    heading: NotRequired[int]
     children: NotRequired[list[Block]]
 
 
-class ExtendedBlock(BlockBase):
-    """A block that has been extended with a link to its page."""
-
-    children: NotRequired[list[ExtendedBlock]]
-    page: ParsedPage
-
-
 class Page(TypedDict):
     """A page from Roam's JSON format."""
 
@@ -53,7 +68,7 @@ class ParsedPage(TypedDict):
     """Slightly modified version of ``Page``."""
 
     title: str
-    children: list[ExtendedBlock]
+    children: list[Block]
     daily: bool
 
 
@@ -64,15 +79,27 @@ class ErrorPage(TypedDict):
     content: list[str]
 
 
-def main():
+class RenderContext(TypedDict):
+    """Everything a worker process needs in order to render pages."""
+
+    pages: list[ParsedPage]
+    uid2block: dict[str, Block]
+    ref_targets: dict[str, str]
+    referenced_uids: set[str]
+    odir: str
+    ddir: str
+
+
+_context: RenderContext
+
+
+def main() -> None:
     if len(sys.argv) == 1:
         print("Usage:")
         print("    python r2o.py <roam json file>")
         return
 
-    j: list[Page] = json.load(
-        open(sys.argv[1], mode="rt", encoding="utf-8", errors="ignore")
-    )
+    j: list[Page] = load_export(sys.argv[1])
 
     odir = "md"  # output dir
     ddir = "md"  # output dir for daily notes
@@ -80,64 +107,71 @@ def main():
 
     print("Pass 1: scan all pages", flush=True)
 
-    uid2block: dict[str, ExtendedBlock] = {}
+    uid2block: dict[str, Block] = {}
+    uid2page: dict[str, ParsedPage] = {}
     referenced_uids: set[str] = set()
     pages: list[ParsedPage] = []
 
-    for page in tqdm(j):
-        title = (
-            page["title"]
-            .replace(":", " -")  # no colons allowed in file names
-            .replace('"', "")
-            .replace("^", "")
-            .replace("\\", "")  # backslashes are also a bad idea
-        )
-        children = page.get("children", [])
+    for roam_page in progress(j, len(j)):
+        title = roam_page["title"].translate(TITLE_TRANS)
+        children = roam_page.get("children", [])
 
         is_daily = False
-        m = re_daily.match(title)
+        m = re_daily.fullmatch(title)
         if m:
             is_daily = True
-            dt = parse(title)
-            title = dt.isoformat().split("T")[0]
+            title = to_iso(m["month"], m["day"], m["year"])
 
-        # type checking complains because there is an implicit conversion going on here
-        # that is hard to express as types
         page_: ParsedPage = {"title": title, "children": children, "daily": is_daily}
-        uid2block.update(scan_blocks(children, page_))
+        scan_blocks(children, page_, uid2block, uid2page)
         pages.append(page_)
 
     print(f"found {len(uid2block)} UIDs", flush=True)
     print("Pass 2: track blockrefs", flush=True)
-    for page in tqdm(pages):
-        render_children(page["children"], uid2block, referenced_uids, render=False)
+    for page in progress(pages, len(pages)):
+        collect_refs(page["children"], uid2block, referenced_uids)
     print(f"found {len(referenced_uids)} referenced UIDs")
+    ref_targets = build_ref_targets(referenced_uids, uid2page)
 
     print("Pass 3: generate")
     error_pages: list[ErrorPage] = []
-    for page in tqdm(pages):
-        title = page["title"]
-        if not title:
+    context: RenderContext = {
+        "pages": pages,
+        "uid2block": uid2block,
+        "ref_targets": ref_targets,
+        "referenced_uids": referenced_uids,
+        "odir": odir,
+        "ddir": ddir,
+    }
+    # pages that end up in the same file (possibly only on a case-insensitive file system) have to
+    # be written one after the other, in their original order, so that the last one wins
+    groups: dict[str, list[int]] = {}
+    ofiln_counts: dict[str, int] = {}
+    for i, page in enumerate(pages):
+        ofiln = output_path(page, odir, ddir)
+        if ofiln is None:
             continue
-        ofiln = f'{odir}/{page["title"]}.md'
-        if page["daily"]:
-            ofiln = f'{ddir}/{page["title"]}.md'
-
-        # hack for crazy slashes in titles
-        if "/" in title:
-            d = odir
-            for part in title.split("/")[:-1]:
-                d = os.path.join(d, part)
-                os.makedirs(d, exist_ok=True)
-
-        lines = render_children(
-            page["children"], uid2block, referenced_uids, render=True
+        groups.setdefault(ofiln.casefold(), []).append(i)
+        ofiln_counts[ofiln] = ofiln_counts.get(ofiln, 0) + 1
+    tasks = list(groups.values())
+
+    # apart from that, pages are rendered independently of each other, so we can spread the groups
+    # over all cores; the look-up tables are sent to each worker only once, the tasks are just
+    # lists of page indices
+    with ProcessPoolExecutor(initializer=init_worker, initargs=(context,)) as executor:
+        results = executor.map(render_pages_by_index, tasks, chunksize=32)
+        for indices, group_results in progress(zip(tasks, results), len(tasks)):
+            for index, lines in zip(indices, group_results):
+                if lines is not None:
+                    error_pages.append({"page": pages[index], "content": lines})
+
+    duplicates = {ofiln: n for ofiln, n in ofiln_counts.items() if n > 1}
+    if duplicates:
+        print(
+            "The following files were written by several pages, only the last one is kept:"
         )
-        try:
-            with open(ofiln, mode="wt", encoding="utf-8") as f:
-                f.write("\n".join(lines))
-        except:
-            error_pages.append({"page": page, "content": lines})
+        for ofiln, n in duplicates.items():
+            print(f"File: >{ofiln}< ({n} pages)")
 
     if error_pages:
         print("The following pages had errors:")
@@ -147,174 +181,333 @@ def main():
             c = ep["content"]
             print(f"Title: >{t}<")
             print(f"Content:")
-            print("    " + "\n    ".join(c))
+            print("".join("    " + line for line in c), end="")
     print("Done!")
 
 
-def scan_blocks(blocks: list[Block], page: ParsedPage) -> dict[str, ExtendedBlock]:
-    """Create a look-up table that allows us to find a block given its UID.
+def progress(iterable: Iterable[T], total: int) -> Iterator[T]:
+    """Wrap ``iterable`` in a progress bar that is only refreshed about 200 times in total."""
+    return iter(
+        tqdm(iterable, total=total, mininterval=0.5, miniters=max(1, total // 200))
+    )
+
+
+def init_worker(context: RenderContext) -> None:
+    """Store the look-up tables that are needed for rendering in a worker process."""
+    global _context
+    _context = context
+
+
+def render_pages_by_index(indices: list[int]) -> list[list[str] | None]:
+    """Render the pages with the given indices in order, using the look-up tables of the worker.
+
+    Returns the result of ``render_page`` for each of the pages.
+    """
+    return [
+        render_page(
+            _context["pages"][index],
+            _context["uid2block"],
+            _context["ref_targets"],
+            _context["referenced_uids"],
+            _context["odir"],
+            _context["ddir"],
+        )
+        for index in indices
+    ]
+
+
+def output_path(page: ParsedPage, odir: str, ddir: str) -> str | None:
+    """Return the path of the markdown file for the given page, or ``None`` if it has no title."""
+    if not page["title"]:
+        return None
+    if page["daily"]:
+        return f'{ddir}/{page["title"]}.md'
+    return f'{odir}/{page["title"]}.md'
+
 
-    For that, we recursively traverse the blocks in a page and record the encountered UIDs together
-    with the block in a dictionary.
+def render_page(
+    page: ParsedPage,
+    uid2block: dict[str, Block],
+    ref_targets: dict[str, str],
+    referenced_uids: set[str],
+    odir: str,
+    ddir: str,
+) -> list[str] | None:
+    """Render a page and write it to its markdown file.
+
+    The lines are written as they are rendered, so the page is never held in memory as a whole.
+    Returns ``None`` on success. If the file could not be written, the page is rendered once more
+    (without repeating the warnings) so that the lines can be returned and reported. A file that
+    was opened but only partially written is removed again; a file that could not be opened in the
+    first place is left alone.
     """
-    u2b: dict[str, ExtendedBlock] = {}
-    for block in blocks:
-        children = block.get("children", [])
+    ofiln = output_path(page, odir, ddir)
+    if ofiln is None:
+        return None
+
+    # hack for crazy slashes in titles
+    if "/" in page["title"]:
+        ensure_dir(os.path.dirname(ofiln))
+
+    try:
+        f = open(
+            ofiln,
+            mode="wt",
+            encoding="utf-8",
+            newline="",
+            buffering=WRITE_BUFFER_SIZE,
+        )
+    except:
+        return list(
+            render_children(
+                page["children"], uid2block, ref_targets, referenced_uids, warn=False
+            )
+        )
+    try:
+        with f:
+            f.writelines(
+                render_children(
+                    page["children"], uid2block, ref_targets, referenced_uids
+                )
+            )
+    except:
+        try:
+            os.remove(ofiln)
+        except OSError:
+            pass
+        return list(
+            render_children(
+                page["children"], uid2block, ref_targets, referenced_uids, warn=False
+            )
+        )
+    return None
+
 
-        # turn the block into an extended block; this means adding the ``page`` entry
-        # unfortunately I don't know how to express this
-        block["page"] = page
-        block = cast(ExtendedBlock, block)
+def ensure_dir(d: str) -> None:
+    """Create the directory ``d`` unless this process has already done so."""
+    if d in _DIRS_DONE:
+        return
+    os.makedirs(d, exist_ok=True)
+    _DIRS_DONE.add(d)
 
-        u2b[block["uid"]] = block
-        u2b.update(scan_blocks(children, page))
-    return u2b
+
+def load_export(filename: str) -> list[Page]:
+    """Load the JSON file exported by Roam.
+
+    The raw bytes are handed to ``orjson`` directly. If it rejects them for any reason (invalid
+    UTF-8, but also e.g. a lone surrogate escape like ``"\\ud83d"``, which ``orjson`` does not
+    accept), we fall back to the more lenient ``json`` module on the text decoded with invalid bytes
+    dropped, just like before ``orjson`` was used.
+    """
+    with open(filename, mode="rb") as f:
+        data = f.read()
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data.decode("utf-8", errors="ignore"))
+
+
+def scan_blocks(
+    blocks: list[Block],
+    page: ParsedPage,
+    uid2block: dict[str, Block],
+    uid2page: dict[str, ParsedPage],
+) -> None:
+    """Fill the look-up tables that allow us to find a block and its page given the block's UID.
+
+    For that, we traverse the blocks in a page with an explicit stack and record the encountered
+    UIDs together with the block in ``uid2block`` and together with the page in ``uid2page``. The
+    blocks themselves are left untouched.
+    """
+    stack = list(reversed(blocks))
+    while stack:
+        block = stack.pop()
+        uid = block["uid"]
+        uid2block[uid] = block
+        uid2page[uid] = page
+
+        children = block.get("children")
+        if children:
+            stack.extend(reversed(children))
+
+
+def collect_refs(
+    children: list[Block],
+    uid2block: dict[str, Block],
+    referenced_uids: set[str],
+) -> None:
+    """Recursively traverse all blocks in a page and record the referenced UIDs."""
+    for block in children:
+        get_referenced_uids(block["string"], uid2block, referenced_uids)
+        collect_refs(block.get("children", []), uid2block, referenced_uids)
 
 
 def render_children(
-    children: list[ExtendedBlock],
-    uid2block: dict[str, ExtendedBlock],
+    children: list[Block],
+    uid2block: dict[str, Block],
+    ref_targets: dict[str, str],
     referenced_uids: set[str],
-    render: bool,
-) -> list[str]:
-    """Traverse all blocks in a page and render them as markdown strings.
+    warn: bool = True,
+) -> Iterator[str]:
+    """Traverse all blocks in a page and render them as newline-terminated markdown strings.
 
-    If ``render`` is set to ``False``, however, we just populate the list of all referenced UIDs.
+    The blocks are visited depth-first with an explicit stack, so every rendered line is yielded in
+    the order in which it appears in the final file.
     """
-    unexpanded_lines: list[str | list[ExtendedBlock]] = [children]
-    has_unexpanded = True
-    level = 0
-
-    while has_unexpanded:
-        lines: list[str | list[ExtendedBlock]] = []
-        has_unexpanded = False
-        for string_or_blocks in unexpanded_lines:
-            if isinstance(string_or_blocks, str):
-                lines.append(string_or_blocks)
-                continue
-            blocks = string_or_blocks
-            for block in blocks:
-                s = block["string"]
-
-                if render:
-                    s = render_blockrefs(s, uid2block, referenced_uids)
-                    prefix = ""
-                    if level >= 1:
-                        prefix = "\t" * level
-                    prefix += "- "
-
-                    headinglevel = block.get("heading", None)
-                    if headinglevel is not None:
-                        prefix += "#" * (headinglevel) + " "
-
-                    uid = block["uid"]
-                    if uid in referenced_uids:
-                        postfix = f" ^{uid}"
-                    else:
-                        postfix = ""
-
-                    # b id magic
-                    s = prefix + s + postfix
-                    if "\n" in s:
-                        new_s = s[:-1]
-                        new_s = new_s.replace("\n", "\n" + prefix[:-2] + "  ")
-                        new_s += s[-1]
-                        s = new_s + "\n"
-
-                    lines.append(s)
-                else:
-                    get_referenced_uids(s, uid2block, referenced_uids)
-                    lines.append("")
-
-                new_children = block.get("children", [])
-                if new_children:
-                    lines.append(new_children)
-                    has_unexpanded = True  # another pass is needed unfortunately
-        unexpanded_lines = lines
-        level += 1
-
-    # type checking complains here that the list may still contain
-    # unrendered list of blocks, but the algorithm is written in a way
-    # where that is not possible
-    return unexpanded_lines
+    stack: list[tuple[Block, int]] = [(b, 0) for b in reversed(children)]
+
+    while stack:
+        block, level = stack.pop()
+        s = render_blockrefs(block["string"], uid2block, ref_targets, warn)
+
+        prefix, continuation = get_prefix(level)
+
+        headinglevel = block.get("heading", None)
+        if headinglevel is not None:
+            prefix += "#" * (headinglevel) + " "
+
+        uid = block["uid"]
+        if uid in referenced_uids:
+            postfix = f" ^{uid}\n"
+        else:
+            postfix = "\n"
+
+        # b id magic
+        line = prefix + s + postfix
+        if "\n" in s:
+            # indent the continuation lines, except for a newline at the very end of the block;
+            # multiline blocks are followed by an empty line
+            n = line.count("\n", 0, len(line) - 2)
+            line = line.replace("\n", continuation, n) + "\n"
+
+        yield line
+
+        for child in reversed(block.get("children", [])):
+            stack.append((child, level + 1))
+
+
+def get_prefix(level: int) -> tuple[str, str]:
+    """Return the bullet prefix for a block at the given nesting level.
+
+    The second entry is what newlines in the block are replaced with, so that continuation lines
+    are indented to the same level. Both are cached in ``_PREFIX_CACHE``, so that they are only
+    built once per level.
+    """
+    prefixes = _PREFIX_CACHE.get(level)
+    if prefixes is None:
+        prefixes = ("\t" * level + "- ", "\n" + "\t" * level + "  ")
+        _PREFIX_CACHE[level] = prefixes
+    return prefixes
 
 
 def render_blockrefs(
-    s: str, uid2block: dict[str, ExtendedBlock], referenced_uids: set[str]
+    s: str, uid2block: dict[str, Block], ref_targets: dict[str, str], warn: bool = True
 ) -> str:
-    """Render block references from Roam such that Obsidian can understand them."""
-    new_s = s
-    startpos = 0
-    while True:
-        m, is_embed = find_blockrefs(new_s, startpos=startpos)
-        if m is None:
-            break
-
-        uid = m.group(2)
-        if uid not in uid2block:
+    """Render block references from Roam such that Obsidian can understand them.
+
+    If ``warn`` is set to ``False``, unknown UIDs are not reported.
+    """
+    # every kind of block reference contains "((", most blocks don't contain any
+    if "((" not in s:
+        return replace_daylinks(s)
+    parts: list[str] = []
+    pos = 0
+    for start, end, uid, is_embed in find_blockrefs(s):
+        replacement = replace_blockref(uid, is_embed, uid2block, ref_targets, warn)
+        if replacement is not None:
+            parts.append(s[pos:start])
+            parts.append(replacement)
+            pos = end
+    parts.append(s[pos:])
+    return replace_daylinks("".join(parts))
+
+
+def find_blockrefs(s: str) -> Iterator[tuple[int, int, str, bool]]:
+    """Find all block references in the given string.
+
+    Yields the start and end of each reference together with the referenced UID and whether the
+    reference is an embed. Block refs, mentions and embeds all contain ``((uid))``, so we only
+    search for that and check the surrounding text for the ``{{embed: ...}}`` or
+    ``{{mentions: ...}}`` wrapper. Unlike an alternation of the three patterns, this allows the
+    regex engine to jump from one ``((`` to the next.
+    """
+    pos = 0
+    for m in re_blockref.finditer(s):
+        start, end = m.span()
+        is_embed = False
+        if s.startswith("}}", end):
+            if start - 9 >= pos and s.startswith("{{embed: ", start - 9):
+                start -= 9
+                end += 2
+                is_embed = True
+            elif start - 12 >= pos and s.startswith("{{mentions: ", start - 12):
+                start -= 12
+                end += 2
+        yield start, end, m.group(1), is_embed
+        pos = end
+
+
+def replace_blockref(
+    uid: str,
+    is_embed: bool,
+    uid2block: dict[str, Block],
+    ref_targets: dict[str, str],
+    warn: bool = True,
+) -> str | None:
+    """Compute the replacement for a single block reference.
+
+    Returns ``None`` if the UID is unknown, in which case the reference should be left as it is.
+    """
+    if uid not in uid2block:
+        if warn:
             print("************** uid not found:", uid)
-            startpos = m.end(2)
-        else:
-            referenced_uids.add(uid)
-            head = new_s[: m.start(1)]
-            r_block = uid2block[uid]
-            # Obsidian doesn't like underscores
-            safe_block_id = r_block["uid"].replace("_", "")
-            if is_embed:
-                replacement = f'![[{r_block["page"]["title"]}#^{safe_block_id}]]'
-            else:
-                # TODO: should the block content be sanitized?
-                block_content = r_block["string"]
-                replacement = (
-                    f'[[{r_block["page"]["title"]}#^{safe_block_id}|{block_content}]]'
-                )
-            tail = new_s[m.end(3) :]
-            new_s = head + replacement + tail
-    return replace_daylinks(new_s)
+        return None
+
+    target = ref_targets[uid]
+    if is_embed:
+        return f"![[{target}]]"
+    # TODO: should the block content be sanitized?
+    block_content = uid2block[uid]["string"]
+    return f"[[{target}|{block_content}]]"
+
+
+def build_ref_targets(
+    referenced_uids: set[str], uid2page: dict[str, ParsedPage]
+) -> dict[str, str]:
+    """Build the Obsidian link target (``page#^blockid``) for every referenced block.
+
+    These only depend on the block, so we compute them once instead of every time the block is
+    referenced.
+    """
+    # Obsidian doesn't like underscores
+    return {
+        uid: f'{uid2page[uid]["title"]}#^{uid.replace("_", "")}'
+        for uid in referenced_uids
+    }
 
 
 def get_referenced_uids(
-    s: str, uid2block: dict[str, ExtendedBlock], referenced_uids: set[str]
+    s: str, uid2block: dict[str, Block], referenced_uids: set[str]
 ) -> None:
     """Extract all UIDs that are referenced in the given string."""
-    startpos = 0
-    while True:
-        m, _ = find_blockrefs(s, startpos)
-        if m is None:
-            break
-        uid = m.group(2)
-        if uid in uid2block:
-            referenced_uids.add(uid)
-        # continue searching after the match
-        startpos = m.end(2)
-
-
-def find_blockrefs(s: str, startpos: int) -> tuple[Match[str] | None, bool]:
-    """Find all block references in the given string."""
-    m = re_blockembed.search(s, pos=startpos)
-    is_embed = True
-    if m is None:
-        is_embed = False
-        m = re_blockmentions.search(s, pos=startpos)
-        if m is None:
-            m = re_blockref.search(s, pos=startpos)
-    return m, is_embed
+    if "((" not in s:
+        return
+    # mentions and embeds wrap a plain block ref, so the wrappers don't matter here
+    referenced_uids.update(uid for uid in re_blockref.findall(s) if uid in uid2block)
 
 
 def replace_daylinks(s: str) -> str:
     """Replace links to the daily notes."""
-    new_s = s
-    while True:
-        m = re_daylink.search(new_s)
-        if not m:
-            break
-        else:
-            head = new_s[: m.end(1)]
-            dt = parse(m.group(2))
-            replacement = dt.isoformat()[:10]
-            tail = "]]" + new_s[m.end(0) :]
-            new_s = head + replacement + tail
-    return new_s
+    if "[[" not in s:
+        return s
+    return re_daylink.sub(
+        lambda m: "[[" + to_iso(m["month"], m["day"], m["year"]) + "]]", s
+    )
+
+
+def to_iso(month: str, day: str, year: str) -> str:
+    """Format a date from Roam's daily note format as YYYY-MM-DD."""
+    return f"{int(year):04d}-{MONTHS[month]:02d}-{int(day):02d}"
 
 
 if __name__ == "__main__":